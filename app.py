@@ -1,8 +1,11 @@
+import glob
+import hashlib
+import os
+import re
+from importlib.metadata import version
 import streamlit as st
 import pandas as pd
 import numpy as np
-import plotly.express as px
-from sklearn.preprocessing import KBinsDiscretizer
 
 # ---------- CONFIG ----------
 st.set_page_config(layout="wide", page_title="Hospital Inpatient Discharges Dashboard")
@@ -20,33 +23,60 @@ COLUMN_MAP = {
     "severity": ["APR Severity of Illness Description", "severity"]
 }
 
+NUMERIC_COLS = ["length_of_stay", "charges"]
+CATEGORICAL_COLS = ["diagnosis", "facility", "county", "payment", "severity"]
+FILTER_COLS = ["facility", "county", "diagnosis", "severity"]
+
+# Columns shown in the filtered data preview
+PREVIEW_COLS = ["facility", "county", "diagnosis", "severity", "age", "length_of_stay", "charges", "payment"]
+
+# Read dtypes keyed on the raw column names for the pyarrow reader. Numeric columns are read as
+# strings too (SPARCS LOS has values like "120 +") and coerced in preprocess
+READ_DTYPES = {}
+for k in NUMERIC_COLS + CATEGORICAL_COLS:
+    for opt in COLUMN_MAP[k]:
+        READ_DTYPES[opt] = "string[pyarrow]"
+
 # ---------- HELPERS ----------
 def load_data(path):
     try:
-        df = pd.read_csv(path)
+        df = pd.read_csv(path, engine="pyarrow", dtype_backend="pyarrow", dtype=READ_DTYPES)
     except Exception:
-        df = pd.read_excel(path)
+        try:
+            df = pd.read_csv(path)
+        except Exception:
+            df = pd.read_excel(path)
     df.columns = df.columns.astype(str)
     return df
 
 def map_columns(df):
     found = {}
-    cols = list(df.columns)
+    cols_set = set(df.columns)
+    lower_cols = {c.lower(): c for c in df.columns}
     for key, options in COLUMN_MAP.items():
         for opt in options:
-            if opt in cols:
+            if opt in cols_set:
                 found[key] = opt
                 break
-        if key not in found:
-            for c in cols:
-                if c.lower() in [o.lower() for o in options]:
-                    found[key] = c
+        else:
+            # Fall back to a case-insensitive match
+            for opt in options:
+                if opt.lower() in lower_cols:
+                    found[key] = lower_cols[opt.lower()]
                     break
     return found
 
 def safe_cast_numeric(df, col):
     if col in df.columns:
-        df[col] = pd.to_numeric(df[col], errors="coerce")
+        # astype folds pyarrow-backed NaN and NA into one missing value so dropna catches both
+        df[col] = pd.to_numeric(df[col], errors="coerce").astype("float64")
+    return df
+
+def attach_los_stats(df):
+    # Dataset-wide LOS stats for the long-stay threshold; attrs carry over to filtered frames
+    los_arr = df["length_of_stay"].to_numpy(dtype="float64", na_value=np.nan)
+    df.attrs["los_mean"] = float(los_arr.mean()) if len(los_arr) else np.nan
+    df.attrs["los_std"] = float(los_arr.std(ddof=1)) if len(los_arr) > 1 else np.nan
     return df
 
 def preprocess(df):
@@ -62,75 +92,184 @@ def preprocess(df):
     for k, v in mapped.items():
         if v:
             std[v] = k
+    # rename returns a new frame, so the caller's df is never mutated and needs no defensive copy
     df = df.rename(columns=std)
     
-    # Cast numeric columns
-    df = safe_cast_numeric(df, "length_of_stay")
-    df = safe_cast_numeric(df, "charges")
+    # Cast numeric columns that the reader didn't already type
+    for c in NUMERIC_COLS:
+        if c in df.columns and not pd.api.types.is_numeric_dtype(df[c]):
+            df = safe_cast_numeric(df, c)
     
     # Clean categorical columns
-    for c in ["diagnosis", "facility", "county", "payment", "severity"]:
+    for c in CATEGORICAL_COLS:
         if c in df.columns:
-            df[c] = df[c].astype(str).fillna("Unknown")
+            df[c] = df[c].fillna("Unknown").astype(str).astype("category")
     
     # Remove rows with no length_of_stay
     if "length_of_stay" in df.columns:
         df = df.dropna(subset=["length_of_stay"])
+        # Drop categories whose rows were all removed so filter options only list values with records
+        for c in CATEGORICAL_COLS:
+            if c in df.columns:
+                df[c] = df[c].cat.remove_unused_categories()
+        attach_los_stats(df)
     
     return df
 
+def sidecar_path(path):
+    # The file name carries a hash of this module's source and the pandas/pyarrow versions, so any
+    # change to the preprocessing code, its settings or the libraries produces a new sidecar
+    # instead of silently reusing a stale one
+    with open(__file__, "rb") as f:
+        source = f.read()
+    schema = source + repr((pd.__version__, version("pyarrow"))).encode("utf-8")
+    digest = hashlib.sha1(schema).hexdigest()[:12]
+    return f"{os.path.splitext(path)[0]}.{digest}.parquet"
+
+# cache_resource hands every rerun the same frame instead of unpickling a copy; callers only
+# derive new frames from it (df.loc[mask]) and never mutate it
+@st.cache_resource(show_spinner=False)
+def get_preprocessed(path):
+    # A Parquet sidecar next to the source file keeps the preprocessed dtypes (categoricals, attrs),
+    # so warm starts skip the CSV parse and preprocessing entirely
+    parquet_path = sidecar_path(path)
+    if os.path.exists(parquet_path) and os.path.getmtime(parquet_path) >= os.path.getmtime(path):
+        try:
+            df = pd.read_parquet(parquet_path, engine="pyarrow")
+        except Exception:
+            pass
+        else:
+            # attrs only round-trip through Parquet on pandas >= 2.1
+            if "length_of_stay" in df.columns and "los_mean" not in df.attrs:
+                attach_los_stats(df)
+            return df
+    df = preprocess(load_data(path))
+    # Write to a temp file and swap it in, so an interrupted write never leaves a truncated sidecar
+    tmp_path = parquet_path + ".tmp"
+    try:
+        df.to_parquet(tmp_path, engine="pyarrow", compression="zstd")
+        os.replace(tmp_path, parquet_path)
+        # Sidecars from older preprocessing versions are never read again; only our own
+        # <base>.<12 hex>.parquet names are touched, never other Parquet files in the folder
+        base = os.path.splitext(path)[0]
+        pattern = re.compile(re.escape(os.path.basename(base)) + r"\.[0-9a-f]{12}\.parquet")
+        for old in glob.glob(glob.escape(base) + ".*.parquet"):
+            if old != parquet_path and pattern.fullmatch(os.path.basename(old)):
+                os.remove(old)
+    except Exception:
+        # Read-only deployments just skip the sidecar
+        if os.path.exists(tmp_path):
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+    return df
+
+@st.cache_data(show_spinner=False)
+def get_raw_preview(path, n=10):
+    # Only the small sample and the column mapping are kept, not the full raw frame
+    df_raw = load_data(path)
+    return df_raw.head(n), map_columns(df_raw)
+
+@st.cache_data(show_spinner=False)
+def get_filter_options(path):
+    # Categories are already unique and sorted, so no scan or sort is needed
+    df = get_preprocessed(path)
+    return {c: df[c].cat.categories.tolist() for c in FILTER_COLS if c in df.columns}
+
+@st.cache_data(show_spinner=False)
+def get_los_bins(path, nbins=30):
+    # Bin edges come from the full dataset so they stay fixed while filters change
+    df = get_preprocessed(path)
+    if "length_of_stay" not in df.columns or df.empty:
+        return nbins
+    return np.histogram_bin_edges(df["length_of_stay"].to_numpy(dtype="float64"), bins=nbins)
+
 # ---------- METRICS ----------
 def compute_metrics(df):
     metrics = {}
     if "length_of_stay" in df.columns:
-        metrics["avg_los"] = df["length_of_stay"].mean()
-        thresh = df["length_of_stay"].mean() + df["length_of_stay"].std()
-        metrics["pct_long_stay"] = (df["length_of_stay"] > thresh).mean() * 100
+        los = df["length_of_stay"].to_numpy(dtype="float64", na_value=np.nan)
+        m = los.mean() if len(los) else np.nan
+        metrics["avg_los"] = m
+        if "los_mean" in df.attrs:
+            thresh = df.attrs["los_mean"] + df.attrs["los_std"]
+        else:
+            thresh = m + los.std(ddof=1) if len(los) > 1 else np.nan
+        # count_nonzero reduces the comparison mask with a popcount instead of a float mean
+        metrics["pct_long_stay"] = np.count_nonzero(los > thresh) / len(los) * 100 if len(los) else np.nan
     else:
         metrics["avg_los"] = None
         metrics["pct_long_stay"] = None
     
     if "charges" in df.columns:
-        metrics["avg_charges"] = df["charges"].mean()
+        charges_arr = df["charges"].to_numpy(dtype="float64", na_value=np.nan)
+        valid_charges = charges_arr[~np.isnan(charges_arr)]
+        metrics["avg_charges"] = valid_charges.mean() if len(valid_charges) else np.nan
     else:
         metrics["avg_charges"] = None
     
     return metrics
 
 # ---------- VISUALIZATIONS ----------
-def vis_avg_stay_by_diagnosis(df, top_n=15):
-    if "diagnosis" not in df.columns or "length_of_stay" not in df.columns:
+def frame_signature(df):
+    # Filtered frames carry their filter selection in attrs; otherwise fall back to hashing the contents
+    key = df.attrs.get("filter_key")
+    if key is not None:
+        return key
+    return pd.util.hash_pandas_object(df).sum()
+
+cache_figure = st.cache_data(max_entries=16, show_spinner=False, hash_funcs={pd.DataFrame: frame_signature})
+
+@cache_figure
+def vis_avg_stay_by_diagnosis(df, cols, top_n=15):
+    import plotly.express as px
+    if "diagnosis" not in cols or "length_of_stay" not in cols:
         return None
-    agg = df.groupby("diagnosis")["length_of_stay"].mean().reset_index().sort_values("length_of_stay", ascending=False).head(top_n)
+    agg = df.groupby("diagnosis", observed=True)["length_of_stay"].mean().nlargest(top_n).reset_index()
     fig = px.bar(agg, x="length_of_stay", y="diagnosis", orientation='h', labels={"length_of_stay":"Avg Length of Stay (days)","diagnosis":"Diagnosis"})
     return fig
 
-def vis_box_charges_by_severity(df):
-    if "charges" not in df.columns or "severity" not in df.columns:
+# Not cached: px.box embeds every filtered row, so unpickling a cached figure is as slow as rebuilding it
+def vis_box_charges_by_severity(df, cols):
+    import plotly.express as px
+    if "charges" not in cols or "severity" not in cols:
         return None
     fig = px.box(df, x="severity", y="charges", labels={"charges":"Total Charges","severity":"Severity"})
     return fig
 
-def vis_heatmap_facility_county(df):
-    if "facility" not in df.columns or "county" not in df.columns or "length_of_stay" not in df.columns:
+@cache_figure
+def vis_heatmap_facility_county(df, cols):
+    import plotly.express as px
+    if "facility" not in cols or "county" not in cols or "length_of_stay" not in cols:
         return None
-    pivot = df.groupby(["facility","county"])["length_of_stay"].mean().reset_index()
-    pivot_table = pivot.pivot(index="facility", columns="county", values="length_of_stay").fillna(0)
+    pivot_table = df.pivot_table(index="facility", columns="county", values="length_of_stay", aggfunc="mean", observed=True, fill_value=0)
     fig = px.imshow(pivot_table, labels=dict(x="County", y="Facility", color="Avg LOS (days)"), aspect="auto")
     return fig
 
-def vis_payment_pie(df):
-    if "payment" not in df.columns:
+@cache_figure
+def vis_payment_pie(df, cols):
+    import plotly.express as px
+    if "payment" not in cols:
         return None
-    counts = df["payment"].value_counts().reset_index()
-    counts.columns = ["payment","count"]
-    fig = px.pie(counts, values="count", names="payment", title="Patient Distribution by Payment Type")
+    # Count directly on the category codes instead of hashing the labels
+    codes = df["payment"].cat.codes.to_numpy()
+    names = df["payment"].cat.categories
+    counts = np.bincount(codes[codes >= 0], minlength=len(names))
+    present = counts > 0
+    fig = px.pie(values=counts[present], names=names[present], title="Patient Distribution by Payment Type")
     return fig
 
-def vis_los_histogram(df):
-    if "length_of_stay" not in df.columns:
+@cache_figure
+def vis_los_histogram(df, cols, bins=30):
+    import plotly.express as px
+    if "length_of_stay" not in cols:
         return None
-    fig = px.histogram(df, x="length_of_stay", nbins=30, labels={"length_of_stay":"Length of Stay (days)"})
+    # Bin on the server and send only the counts to the browser
+    counts, edges = np.histogram(df["length_of_stay"].to_numpy(dtype="float64", na_value=np.nan), bins=bins)
+    centers = 0.5 * (edges[:-1] + edges[1:])
+    fig = px.bar(x=centers, y=counts, labels={"x":"Length of Stay (days)","y":"count"})
+    fig.update_layout(bargap=0)
     return fig
 
 # ---------- STREAMLIT LAYOUT ----------
@@ -139,43 +278,56 @@ def main():
     st.markdown("**Purpose:** Explore length of stay, charges, and patterns across diagnosis, facilities, and payment types.")
     
     with st.spinner("Loading data..."):
-        df_raw = load_data(DATA_PATH)
+        df = get_preprocessed(DATA_PATH)
+    cols = frozenset(df.columns)
     
     st.sidebar.header("Filters & Settings")
     st.sidebar.markdown("Data source: `" + DATA_PATH + "`")
     
-    df = preprocess(df_raw.copy())
-    
     if st.sidebar.checkbox("Show raw sample / column mapping", value=False):
+        # The raw CSV is only parsed when the user asks to see it
+        raw_sample, raw_mapping = get_raw_preview(DATA_PATH)
         st.subheader("Raw data sample")
-        st.dataframe(df_raw.head(10))
+        st.dataframe(raw_sample)
         st.write("Detected standardized columns:", list(df.columns))
-        st.write("Column mapping details:", map_columns(df_raw))
+        st.write("Column mapping details:", raw_mapping)
     
+    options = get_filter_options(DATA_PATH)
     filters = {}
     if "facility" in df.columns:
-        facs = sorted(df["facility"].unique().tolist())
+        facs = options["facility"]
         selection = st.sidebar.multiselect("Facility", options=facs, default=facs[:5])
         filters["facility"] = selection
     
     if "county" in df.columns:
-        cnts = sorted(df["county"].unique().tolist())
+        cnts = options["county"]
         selection = st.sidebar.multiselect("County", options=cnts, default=cnts)
         filters["county"] = selection
     
     if "diagnosis" in df.columns:
-        diags = sorted(df["diagnosis"].unique().tolist())
+        diags = options["diagnosis"]
         selection = st.sidebar.multiselect("Diagnosis", options=diags[:100], default=diags[:10])
         filters["diagnosis"] = selection
     
     if "severity" in df.columns:
-        sevs = sorted(df["severity"].unique().tolist())
+        sevs = options["severity"]
         selection = st.sidebar.multiselect("Severity", options=sevs, default=sevs)
         filters["severity"] = selection
     
+    # Combine all filters into one mask so the frame is only indexed once
+    mask = np.ones(len(df), dtype=bool)
     for k, v in filters.items():
         if v:
-            df = df[df[k].isin(v)]
+            col = df[k]
+            if isinstance(col.dtype, pd.CategoricalDtype):
+                # Resolve the selection against the categories once, then look rows up by code;
+                # the trailing False maps missing values (code -1) to excluded
+                keep = np.append(col.cat.categories.isin(v), False)
+                mask &= keep[col.cat.codes.to_numpy()]
+            else:
+                mask &= col.isin(v).to_numpy()
+    df = df.loc[mask]
+    df.attrs["filter_key"] = (DATA_PATH, tuple((k, tuple(sorted(v))) for k, v in filters.items()))
     
     metrics = compute_metrics(df)
     
@@ -189,46 +341,46 @@ def main():
     left, right = st.columns((2,1))
     with left:
         st.subheader("Avg Length of Stay by Diagnosis")
-        fig1 = vis_avg_stay_by_diagnosis(df)
+        fig1 = vis_avg_stay_by_diagnosis(df, cols)
         if fig1:
-            st.plotly_chart(fig1, use_container_width=True)
+            st.plotly_chart(fig1, key="los_by_diag", use_container_width=True)
         else:
             st.info("Diagnosis / LOS columns not found.")
         
         st.subheader("Length of Stay Distribution")
-        fig_hist = vis_los_histogram(df)
+        fig_hist = vis_los_histogram(df, cols, bins=get_los_bins(DATA_PATH))
         if fig_hist:
-            st.plotly_chart(fig_hist, use_container_width=True)
+            st.plotly_chart(fig_hist, key="los_hist", use_container_width=True)
     
     with right:
         st.subheader("Charges by Severity (Boxplot)")
-        fig2 = vis_box_charges_by_severity(df)
+        fig2 = vis_box_charges_by_severity(df, cols)
         if fig2:
-            st.plotly_chart(fig2, use_container_width=True)
+            st.plotly_chart(fig2, key="charges_by_severity", use_container_width=True)
         else:
             st.info("Charges or Severity column missing.")
         
         st.subheader("Payment Type Distribution")
-        fig3 = vis_payment_pie(df)
+        fig3 = vis_payment_pie(df, cols)
         if fig3:
-            st.plotly_chart(fig3, use_container_width=True)
+            st.plotly_chart(fig3, key="payment_pie", use_container_width=True)
         else:
             st.info("Payment column missing.")
     
     st.markdown("---")
     st.subheader("Facility × County — Avg LOS Heatmap")
-    fig4 = vis_heatmap_facility_county(df)
+    fig4 = vis_heatmap_facility_county(df, cols)
     if fig4:
-        st.plotly_chart(fig4, use_container_width=True)
+        st.plotly_chart(fig4, key="facility_county_heatmap", use_container_width=True)
     else:
         st.info("Facility / County / LOS columns missing for heatmap.")
     
     st.markdown("---")
     st.subheader("Data Table (filtered)")
-    st.dataframe(df.head(100))
+    st.dataframe(df.loc[:, [c for c in PREVIEW_COLS if c in df.columns]].head(100))
     
     st.markdown("### Notes")
-    st.markdown("- Long stay threshold = mean + 1 * std")
+    st.markdown("- Long stay threshold = mean + 1 * std of LOS across the full dataset")
     st.markdown("- Column mapping automatically detects your data structure.")
 
 if __name__ == "__main__":